@@ -4,18 +4,32 @@ import sys
 import imaplib
 import email
 import email.utils
+from email import policy
+from email.parser import BytesParser
 import re
 import json
+import collections
+import hashlib
+import concurrent.futures
+import select
+import ssl
+import time
 import argparse
 import datetime
-from unidecode import unidecode
+from unidecode import unidecode_expect_ascii
 import unicodedata
 from dateutil.parser import parse
 from feedgen.feed import FeedGenerator
 
+# orjson serializes the state file much faster; fall back to json when it isn't installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # New imports for fetching web titles
 import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 
 # --- Configuration ---
 IMAP_HOST = 'imap.gmail.com'
@@ -25,6 +39,15 @@ EMAIL_FOLDER = os.getenv('EMAIL_FOLDER')
 OUT_PATH = os.getenv('OUT_PATH')
 BASE_URL = os.getenv('BASE_URL')
 STATE_FILE = os.path.join(OUT_PATH, 'metadata.json')
+RSS_FILE = os.path.join(OUT_PATH, 'rss.xml')
+FEED_HASH_FILE = os.path.join(OUT_PATH, '.rss_hash')
+MAX_ENTRIES = 20
+FETCH_BATCH_SIZE = int(os.getenv('FETCH_BATCH_SIZE', '100'))
+FETCH_PIPELINE_DEPTH = int(os.getenv('FETCH_PIPELINE_DEPTH', '4'))
+FETCH_CONNECTIONS = int(os.getenv('FETCH_CONNECTIONS', '3'))
+# Gmail drops connections idle for more than 29 minutes
+IDLE_TIMEOUT = 25 * 60
+RECONNECT_DELAY = 60
 
 try:
     os.makedirs(OUT_PATH)
@@ -33,38 +56,127 @@ except FileExistsError:
 
 # --- Helper Functions ---
 
+class ControlCharTable(dict):
+    """str.translate table dropping Unicode category C; filled lazily per code point."""
+    def __missing__(self, codepoint):
+        value = None if unicodedata.category(chr(codepoint))[0] == "C" else codepoint
+        self[codepoint] = value
+        return value
+
+CONTROL_CHAR_TABLE = ControlCharTable()
+
 def remove_control_characters(s):
-    return "".join(ch for ch in str(s) if unicodedata.category(ch)[0]!="C")
+    return str(s).translate(CONTROL_CHAR_TABLE)
 
 def clean_author_name(name):
     if not name:
         return name
-    name = str(email.header.make_header(email.header.decode_header(name)))
+    # policy.default already decodes headers; only legacy state entries hold RFC 2047 words
+    if '=?' in name:
+        name = str(email.header.make_header(email.header.decode_header(name)))
     if '|' in name:
         name = name[:name.index('|')].strip()
     return name
 
+def batched(seq, n):
+    """Yields successive n-sized slices of seq."""
+    for i in range(0, len(seq), n):
+        yield seq[i:i + n]
+
+FETCH_UID_RE = re.compile(rb'\bUID (\d+)')
+ID_RE = re.compile('[^0-9a-zA-Z]+')
+IDLE_CHANGE_RE = re.compile(rb'\* \d+ (EXISTS|EXPUNGE)\b')
+# The modern policy decodes RFC 2047 headers into str on access
+MESSAGE_PARSER = BytesParser(policy=policy.default)
+# Only <title> is needed from fetched pages; the strainer makes the parser skip the rest
+TITLE_STRAINER = SoupStrainer('title')
+
+def parse_fetch_response(data):
+    """Yields (uid, payload) pairs from a multi-message UID FETCH response."""
+    pending = None
+    for item in data:
+        if isinstance(item, tuple):
+            # (b'1 (UID 42 BODY[] {size}', payload); some servers send UID after the literal
+            match = FETCH_UID_RE.search(item[0])
+            if match:
+                yield int(match.group(1)), item[1]
+                pending = None
+            else:
+                pending = item[1]
+        elif pending is not None and item:
+            match = FETCH_UID_RE.search(item)
+            if match:
+                yield int(match.group(1)), pending
+            pending = None
+
+def pipelined_fetch(M, uid_batches, message_parts):
+    """Runs UID FETCH for every batch, keeping FETCH_PIPELINE_DEPTH commands in flight.
+
+    RFC 3501 allows sending commands before earlier ones complete; the server
+    answers them in order, so each tagged completion only drains its own
+    untagged FETCH data. Yields (rv, data) per batch, like M.uid('fetch', ...).
+    """
+    in_flight = collections.deque()
+    for batch in uid_batches:
+        uid_set = b','.join(str(uid).encode() for uid in batch)
+        in_flight.append(M._command('UID', 'FETCH', uid_set, message_parts))
+        if len(in_flight) >= FETCH_PIPELINE_DEPTH:
+            yield complete_fetch(M, in_flight.popleft())
+    while in_flight:
+        yield complete_fetch(M, in_flight.popleft())
+
+def complete_fetch(M, tag):
+    """Waits for a pipelined UID FETCH to finish and returns its (rv, data)."""
+    rv, data = M._command_complete('UID', tag)
+    return M._untagged_response(rv, data, 'FETCH')
+
+def utc_isoformat(date_obj):
+    """Formats a datetime as a UTC ISO-8601 string, which sorts chronologically as text."""
+    return date_obj.astimezone(datetime.timezone.utc).isoformat()
+
 def load_state():
     """Loads the last seen UID and previous entries."""
     if os.path.exists(STATE_FILE):
         try:
-            with open(STATE_FILE, 'r') as f:
-                data = json.load(f)
-                return data.get('last_uid', 0), data.get('entries', [])
-        except json.JSONDecodeError:
+            with open(STATE_FILE, 'rb') as f:
+                raw = f.read()
+                data = orjson.loads(raw) if orjson else json.loads(raw)
+                entries = data.get('entries', [])
+                # Older state files stored dates in the sender's timezone
+                for entry in entries:
+                    if not entry['date'].endswith('+00:00'):
+                        entry['date'] = utc_isoformat(parse(entry['date']))
+                return data.get('last_uid', 0), entries
+        except json.JSONDecodeError:  # orjson.JSONDecodeError subclasses it
             pass
     return 0, []
 
+def merge_entries(entries, new_entries):
+    """Combines entry lists, keeping one entry per email UID (or link for manual entries)."""
+    merged = {}
+    for entry in entries + new_entries:
+        merged[entry.get('uid', entry['link'])] = entry
+    return list(merged.values())
+
 def save_state(last_uid, entries):
     """Saves the high-water mark UID and the entry history."""
-    entries = sorted(entries, key=lambda x: parse(x['date']), reverse=True)[:20]
-    with open(STATE_FILE, 'w') as f:
-        json.dump({'last_uid': last_uid, 'entries': entries}, f, indent=4)
+    entries = sorted(entries, key=lambda x: x['date'], reverse=True)[:MAX_ENTRIES]
+    state = {'last_uid': last_uid, 'entries': entries}
+    with open(STATE_FILE, 'wb') as f:
+        f.write(orjson.dumps(state) if orjson else json.dumps(state).encode())
 
 def generate_feed(entries):
     """Regenerates the RSS file from the list of entries."""
-    # 1. Sort the list: Newest -> Oldest
-    sorted_entries = sorted(entries, key=lambda x: parse(x['date']), reverse=True)
+    # 1. Sort the list: Newest -> Oldest, keeping only what the state file retains
+    sorted_entries = sorted(entries, key=lambda x: x['date'], reverse=True)[:MAX_ENTRIES]
+
+    # Skip the rewrite if the feed would come out identical to the one on disk
+    feed_hash = hashlib.blake2b(json.dumps(sorted_entries, sort_keys=True).encode()).hexdigest()
+    if os.path.exists(RSS_FILE) and os.path.exists(FEED_HASH_FILE):
+        with open(FEED_HASH_FILE, 'r') as f:
+            if f.read() == feed_hash:
+                print("RSS Feed unchanged.")
+                return
 
     fg = FeedGenerator()
     fg.id(f'{BASE_URL}/rss.xml')
@@ -77,27 +189,36 @@ def generate_feed(entries):
         fe = fg.add_entry(order='append')
         fe.id(entry['link'])
         fe.title(entry.get('subject', entry['title']))
-        fe.updated(parse(entry['date']))
+        fe.updated(datetime.datetime.fromisoformat(entry['date']))
         fe.link(href=entry['link'], rel='self')
-        fe.description(entry.get('description', ''))
-        fe.summary(entry.get('description', ''), type='html')
+        description = entry.get('description', '')
+        fe.description(description)
+        fe.summary(description, type='html')
         if entry.get('author'):
             fe.author(name=entry.get('author_name') or entry['author'], email=entry['author'])
 
-    fg.atom_file(os.path.join(OUT_PATH, 'rss.xml'))
+    fg.atom_file(RSS_FILE)
+    with open(FEED_HASH_FILE, 'w') as f:
+        f.write(feed_hash)
     print(f"RSS Feed generated with {len(sorted_entries)} items (Newest first).")
 
 # --- Core Logic ---
 
-def fetch_web_title(url):
+# <title> lives in <head>, so the start of the page is enough. Closing a response
+# before it is fully read drops its connection, so only pages this small are pooled.
+TITLE_READ_BYTES = 16384
+TITLE_FETCH_WORKERS = 8
+
+def fetch_web_title(session, url):
     """Fetches the <title> tag from a URL."""
     print(f"Fetching title for: {url}...")
     try:
         headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
-        response = requests.get(url, headers=headers, timeout=10)
+        with session.get(url, headers=headers, timeout=10, stream=True) as response:
+            content = response.raw.read(TITLE_READ_BYTES, decode_content=True)
         
         if response.status_code == 200:
-            soup = BeautifulSoup(response.content, 'html.parser')
+            soup = BeautifulSoup(content, 'lxml', parse_only=TITLE_STRAINER)
             if soup.title and soup.title.string:
                 return soup.title.string.strip()
     except Exception as e:
@@ -105,27 +226,77 @@ def fetch_web_title(url):
     
     return url  # Fallback to URL if title fetch fails
 
-def add_manual_link(url):
-    """Adds a custom web link to the feed, automatically parsing the title."""
+def add_manual_links(urls):
+    """Adds custom web links to the feed, automatically parsing their titles."""
     last_uid, entries = load_state()
     
-    title = fetch_web_title(url)
+    # Title fetches are network-bound, so fetch them concurrently over one pooled session
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=TITLE_FETCH_WORKERS)
+    with requests.Session() as session, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=TITLE_FETCH_WORKERS) as executor:
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        titles = list(executor.map(lambda url: fetch_web_title(session, url), urls))
     
-    new_entry = {
-        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
-        'title': title,
-        'link': url,
-        'description': f"External Link: {title}",
-        'author': 'manual@link'
-    }
+    new_entries = []
+    for url, title in zip(urls, titles):
+        new_entries.append({
+            'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'title': title,
+            'link': url,
+            'description': f"External Link: {title}",
+            'author': 'manual@link'
+        })
     
-    entries.append(new_entry)
+    entries = merge_entries(entries, new_entries)
     save_state(last_uid, entries)
     generate_feed(entries)
-    print(f"Successfully added: {title}")
-
-def fetch_emails():
-    """Connects to IMAP, fetches new emails, and updates the feed."""
+    for title in titles:
+        print(f"Successfully added: {title}")
+
+def build_entry(uid, raw):
+    """Parses a raw RFC822 message and returns its feed entry and body bytes."""
+    msg = MESSAGE_PARSER.parsebytes(raw)
+    subject = str(msg['Subject'] or '')
+
+    # Extract sender email
+    from_header = msg.get('From')
+    name, sender_email = email.utils.parseaddr(from_header)
+
+    # get_body only inspects part headers, so attachments are never decoded
+    body_part = msg.get_body(preferencelist=('html', 'plain'))
+    body_bytes = (body_part.get_payload(decode=True) if body_part else None) or b''
+
+    id_ = ID_RE.sub('_', unidecode_expect_ascii(subject))
+    file_name = f'{id_}.html'
+
+    # The feed shows the whole newsletter; a raw HTML prefix would be cut mid-tag
+    body = body_bytes.decode('utf-8', errors='backslashreplace')
+
+    date_obj = parse(msg['Date'])
+    entry = {
+        'uid': uid,
+        'date': utc_isoformat(date_obj),
+        'title': id_,
+        'subject': subject,
+        'link': f'{BASE_URL}/{file_name}',
+        'description': remove_control_characters(body.strip()),
+        'author': sender_email,
+        'author_name': clean_author_name(name),
+    }
+    return entry, body_bytes
+
+def write_bodies(fetched):
+    """Writes (entry, body_bytes) pairs to disk; the newest UID wins when subjects repeat."""
+    bodies = {}
+    for entry, body_bytes in sorted(fetched, key=lambda x: x[0]['uid']):
+        bodies[f"{entry['title']}.html"] = body_bytes
+    for file_name, body_bytes in bodies.items():
+        with open(os.path.join(OUT_PATH, file_name), 'wb') as fp:
+            fp.write(body_bytes)
+
+def imap_login():
+    """Opens an authenticated IMAP connection, exiting if the login is rejected."""
     M = imaplib.IMAP4_SSL(IMAP_HOST)
 
     try:
@@ -134,12 +305,137 @@ def fetch_emails():
         print("LOGIN FAILED!!!")
         sys.exit(1)
 
+    return M
+
+def fetch_entries(M, uids):
+    """Fetches the given UIDs over M and returns their (entry, body_bytes) pairs."""
+    entries = []
+    for rv, data in pipelined_fetch(M, batched(uids, FETCH_BATCH_SIZE), '(BODY.PEEK[])'):
+        if rv != 'OK': continue
+
+        for uid, raw in parse_fetch_response(data):
+            entries.append(build_entry(uid, raw))
+    return entries
+
+def fetch_entries_on_new_connection(uids):
+    """Like fetch_entries, but over a dedicated connection so it can run in a worker thread."""
+    M = imap_login()
+    rv, data = M.select(EMAIL_FOLDER)
+    if rv != 'OK':
+        M.logout()
+        raise M.error(f"Unable to open mailbox {rv}")
+
+    try:
+        return fetch_entries(M, uids)
+    finally:
+        M.close()
+        M.logout()
+
+def idle_data_ready(M, timeout):
+    """Waits up to timeout seconds for IDLE data, including data imaplib has already buffered."""
+    # select() only sees the socket, not lines sitting in M.file's buffer or the SSL layer
+    M.sock.settimeout(0)
+    try:
+        if M.file.peek(1):
+            return True
+    except (BlockingIOError, ssl.SSLWantReadError):
+        pass
+    finally:
+        M.sock.settimeout(None)
+    return bool(select.select([M.sock], [], [], timeout)[0])
+
+def wait_for_changes(M, timeout):
+    """Blocks in IMAP IDLE until the selected mailbox changes or timeout seconds pass."""
+    # imaplib keeps EXISTS/EXPUNGE reported during earlier commands; those changes are not resent
+    changed = False
+    for name in ('EXISTS', 'EXPUNGE'):
+        if M.untagged_responses.pop(name, None):
+            changed = True
+    if changed:
+        return
+
+    if 'IDLE' not in M.capabilities:
+        time.sleep(timeout)
+        M.noop()
+        return
+
+    tag = M._new_tag()
+    M.send(tag + b' IDLE\r\n')
+    # Untagged responses may legally arrive before the continuation
+    while True:
+        line = M.readline()
+        if line.startswith(b'+'):
+            break
+        if not line.startswith(b'* '):
+            raise M.abort(f'IDLE rejected: {line!r}')
+        if IDLE_CHANGE_RE.match(line):
+            changed = True
+
+    deadline = time.monotonic() + timeout
+    while not changed:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not idle_data_ready(M, remaining):
+            break
+        line = M.readline()
+        if not line:
+            raise M.abort('connection closed during IDLE')
+        if IDLE_CHANGE_RE.match(line):
+            changed = True
+
+    M.send(b'DONE\r\n')
+    while not line.startswith(tag):
+        line = M.readline()
+        if not line:
+            raise M.abort('connection closed during IDLE')
+    # The tagged reply was read by hand, so imaplib never cleared its slot for it
+    M.tagged_commands.pop(tag, None)
+
+def run_daemon():
+    """Keeps one IMAP session open, syncing whenever the server reports mailbox changes."""
+    while True:
+        M = None
+        try:
+            M = imap_login()
+            rv, data = M.select(EMAIL_FOLDER)
+            if rv != 'OK':
+                print("ERROR: Unable to open mailbox ", rv)
+                M.logout()
+                return
+            # SELECT always reports EXISTS; the first sync covers it
+            M.untagged_responses.pop('EXISTS', None)
+
+            while True:
+                sync_mailbox(M)
+                wait_for_changes(M, IDLE_TIMEOUT)
+        # A BAD reply leaves the session in an unknown state, so it gets a fresh one too
+        except (imaplib.IMAP4.error, OSError) as e:
+            print(f"IMAP session failed ({e}), reconnecting in {RECONNECT_DELAY}s...")
+            if M is not None:
+                # Gmail caps concurrent connections, so don't leave the old one to the GC
+                try:
+                    M.shutdown()
+                except OSError:
+                    pass
+            time.sleep(RECONNECT_DELAY)
+
+def fetch_emails():
+    """Connects to IMAP, fetches new emails, and updates the feed."""
+    M = imap_login()
+
     rv, data = M.select(EMAIL_FOLDER)
     if rv != 'OK':
         print("ERROR: Unable to open mailbox ", rv)
         M.logout()
         return
 
+    try:
+        sync_mailbox(M)
+    finally:
+        M.close()
+        M.logout()
+
+def sync_mailbox(M):
+    """Fetches new emails from the selected mailbox and updates the state and feed."""
     last_uid, existing_entries = load_state()
     print(f"Checking for new emails (Last UID: {last_uid})...")
 
@@ -154,63 +450,38 @@ def fetch_emails():
     if removed:
         print(f"Removed {removed} entries no longer in folder.")
 
-    new_uids = sorted(uid for uid in current_uids if uid > last_uid)
+    # Skipping UIDs already in the state keeps a reset last_uid from duplicating entries
+    seen_uids = {e['uid'] for e in existing_entries if 'uid' in e}
+    new_uids = sorted(uid for uid in current_uids if uid > last_uid and uid not in seen_uids)
 
     new_entries = []
     current_max_uid = last_uid
 
     if new_uids:
-        for uid in new_uids:
-            uid_bytes = str(uid).encode()
-            current_max_uid = max(current_max_uid, uid)
-            
-            rv, data = M.uid('fetch', uid_bytes, '(RFC822)')
-            if rv != 'OK': continue
-
-            msg = email.message_from_bytes(data[0][1])
-            subject = str(email.header.make_header(email.header.decode_header(msg['Subject'])))
-            
-            # Extract sender email
-            from_header = msg.get('From')
-            name, sender_email = email.utils.parseaddr(from_header)
-
-            body, current_ctype = "", None
-            if msg.is_multipart():
-                for part in msg.walk():
-                    ctype = part.get_content_type()
-                    if current_ctype is None or ctype == 'text/html':
-                        body = (part.get_payload(decode=True) or b'').decode('utf-8', errors='backslashreplace')
-            else:
-                body = (msg.get_payload(decode=True) or b'').decode('utf-8', errors='backslashreplace')
-
-            id_ = re.sub('[^0-9a-zA-Z]+', '_', unidecode(subject))
-            file_name = f'{id_}.html'
-            with open(os.path.join(OUT_PATH, file_name), 'w') as fp:
-                fp.write(body)
-
-            date_obj = parse(msg['Date'])
-            new_entries.append({
-                'uid': uid,
-                'date': date_obj.isoformat(),
-                'title': id_,
-                'subject': subject,
-                'link': f'{BASE_URL}/{file_name}',
-                'description': remove_control_characters(body.strip()),
-                'author': sender_email,
-                'author_name': clean_author_name(name),
-            })
-        
+        current_max_uid = max(current_max_uid, new_uids[-1])
+
+        # Extra connections only pay off when there is more than one batch to fetch
+        connections = min(FETCH_CONNECTIONS, -(-len(new_uids) // FETCH_BATCH_SIZE))
+        partitions = [new_uids[i::connections] for i in range(connections)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as executor:
+            futures = [executor.submit(fetch_entries_on_new_connection, p) for p in partitions[1:]]
+            fetched = fetch_entries(M, partitions[0])
+            for future in futures:
+                fetched.extend(future.result())
+
+        # Workers finish in any order, so bodies are written only once all are in
+        write_bodies(fetched)
+        new_entries = [entry for entry, _ in fetched]
+
         print(f"Processed {len(new_entries)} new emails.")
     else:
         print("No new emails.")
 
-
-    M.close()
-    M.logout()
-
-    all_entries = existing_entries + new_entries
+    all_entries = merge_entries(existing_entries, new_entries)
     print([e['title'] for e in all_entries])
     save_state(current_max_uid, all_entries)
+    if not new_entries and not removed and os.path.exists(RSS_FILE):
+        return
     generate_feed(all_entries)
 
 def migrate_entries():
@@ -225,24 +496,18 @@ def migrate_entries():
         print("All entries already have author_name and subject.")
         return
 
-    M = imaplib.IMAP4_SSL(IMAP_HOST)
-    try:
-        M.login(EMAIL_ACCOUNT, IMAP_PASSWORD)
-    except imaplib.IMAP4.error:
-        print("LOGIN FAILED!!!")
-        sys.exit(1)
-
+    M = imap_login()
     M.select(EMAIL_FOLDER)
 
     for entry in needs_update:
         uid = entry['uid']
-        rv, data = M.uid('fetch', str(uid).encode(), '(RFC822.HEADER)')
+        rv, data = M.uid('fetch', str(uid).encode(), '(BODY.PEEK[HEADER])')
         if rv != 'OK':
             print(f"Could not fetch UID {uid}")
             continue
 
-        msg = email.message_from_bytes(data[0][1])
-        subject = str(email.header.make_header(email.header.decode_header(msg['Subject'])))
+        msg = MESSAGE_PARSER.parsebytes(data[0][1], headersonly=True)
+        subject = str(msg['Subject'] or '')
         from_header = msg.get('From')
         name, _ = email.utils.parseaddr(from_header)
 
@@ -262,14 +527,17 @@ def migrate_entries():
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Email to RSS with Manual Link Support")
-    parser.add_argument('--add', metavar='URL', help='Add a manual link to the RSS feed')
+    parser.add_argument('--add', metavar='URL', nargs='+', help='Add manual links to the RSS feed')
     parser.add_argument('--migrate', action='store_true', help='Backfill author_name and subject for existing entries')
+    parser.add_argument('--daemon', action='store_true', help='Stay connected and update the feed as new emails arrive (IMAP IDLE)')
 
     args = parser.parse_args()
 
     if args.add:
-        add_manual_link(args.add)
+        add_manual_links(args.add)
     elif args.migrate:
         migrate_entries()
+    elif args.daemon:
+        run_daemon()
     else:
         fetch_emails()